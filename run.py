@@ -31,14 +31,31 @@ __version__ = "0.0.0"
 
 
 import argparse
+import atexit
+import errno
+import functools
+import grp
 import json
 import logging
+import logging.handlers
+import math
 import os
 import re
+import signal
+import sys
 import time
 from bids import BIDSLayout
+from bids.layout import BIDSLayoutIndexer
+from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from glob import glob
-from shutil import copy, chown
+from shutil import copyfileobj, copymode
+
+try:
+    # orjson is much faster than json, but is optional.
+    import orjson
+except ImportError:
+    orjson = None
 
 def _cli():
     """
@@ -56,9 +73,17 @@ def _cli():
             't1_session_label': args.t1_session_label,
             't2_session_label': args.t2_session_label,
             'dataset_name': args.dataset_name,
-            'owner_group': args.owner_group
+            'owner_group': args.owner_group,
+            'jobs': args.jobs,
+            'layout_db': args.layout_db,
+            'link_mode': args.link_mode,
+            'drop_cache': args.drop_cache
             }
 
+    # Exit normally on SIGTERM (e.g. a batch system's time limit), so the copies
+    # finished so far are logged and the buffered log is written out.
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit( 128 + signum ) )
+
     interface(**kwargs)
 
 
@@ -136,45 +161,592 @@ def generate_parser(parser=None):
                 help='Optional group name or ID, to own new paths and files. '
                      'Default is None -- i.e., do not change the owner. '
                 )
+        parser.add_argument(
+                '--jobs',
+                dest='jobs',
+                type=int,
+                default=None,
+                help='Optional number of func and fmap files to copy '
+                     'concurrently. The (larger) anat files are copied at most '
+                     '4 at a time. Default is min(32, 4 * number of CPUs). '
+                )
+        parser.add_argument(
+                '--layout-db',
+                dest='layout_db',
+                default=None,
+                help='Optional path of a BIDSLayout database. If the database '
+                     'exists, it is loaded instead of indexing bids_dir again; '
+                     'otherwise bids_dir is indexed and the database is saved '
+                     'there for the next run. '
+                     'Default is None -- i.e., index bids_dir every time. '
+                )
+        parser.add_argument(
+                '--link-mode',
+                dest='link_mode',
+                choices=LINK_MODES,
+                default='copy',
+                help='How to put each nii file in the new dataset. "copy" '
+                     'copies the data. "reflink" makes a copy-on-write clone, '
+                     'which needs no extra space but only works on some '
+                     'filesystems (e.g., XFS, Btrfs, APFS). "hardlink" makes a '
+                     'hard link to the original file, so the two share their '
+                     'contents, owner and permissions (and so it cannot be used '
+                     'with --owner-group). "symlink" makes a symbolic link to '
+                     'the original file, so the new dataset breaks if the '
+                     'original is moved or deleted. "auto" tries reflink, then '
+                     'hardlink (unless --owner-group is given), then copy. '
+                     'The json files are always written out. '
+                     'Default is "copy". '
+                )
+        parser.add_argument(
+                '--drop-cache',
+                dest='drop_cache',
+                action='store_true',
+                help='Wait for each copied file to be written to disk '
+                     '(fdatasync), then ask the kernel to drop it from the page '
+                     'cache, so that copying a large dataset does not push out '
+                     'data that other processes on the node are using. This '
+                     'makes each copy wait for the disk. '
+                )
 
         return parser
 
-def make_unisession_files( src_nii, dest_dir, dest_filename, group=None ):
-    # Copy both the nii file, and the associated json file.
-    # Make sure the new files have the correct group owner.
-    # Add the nii's source path into the new .json file.
+# Patterns used to rewrite BIDS filenames, compiled once.
+_SES_RE = re.compile( r'_ses-[^_]+' )
+# The key-value entities (e.g., 'ses-01', 'run-2') in a BIDS filename.
+_BIDS_ENT_RE = re.compile( r'(?:^|_)([a-z0-9]+)-([^_]+)' )
+
+def parse_entities( filename ):
+    """
+    Get the entities from a BIDS filename, keyed as they appear in the filename.
+    E.g., 'sub-X_ses-Y_task-rest_dir-PA_bold.nii.gz' gives
+    {'sub': 'X', 'ses': 'Y', 'task': 'rest', 'dir': 'PA'}.
+    This is much quicker than asking pybids for a file's entities.
+    :param filename: BIDS filename, without its directories.
+    :return: dict of entity values.
+    """
+    return dict( _BIDS_ENT_RE.findall( filename ) )
+
+# Session, run and task parts of a func filename, so it can be rewritten in one pass.
+_REWRITE_RE = re.compile( r'(_ses-[^_]+)|(_run-\d+)|(task-[^_]+)' )
+
+def _rewrite_func_part( m, task, run_str, has_run ):
+    # Drop the session, and renumber the run. If there is no run, add it after the task.
+    if m.group(1):
+        return ''
+    if m.group(2):
+        return run_str
+    if has_run:
+        return m.group(3)
+    return 'task-' + task + run_str
+
+# Buffer size used when neither copy_file_range nor sendfile can be used.
+COPY_BUFSIZE = 4 * 1024 * 1024
+
+# Errors that mean the kernel cannot do an in-kernel copy between these files,
+# so we should fall back to a slower way of copying.
+_NO_KERNEL_COPY = ( errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP )
+
+def _sendfile( dst_fd, src_fd, offset, count ):
+    return os.sendfile( dst_fd, src_fd, offset, count )
+
+def _copy_file_range( dst_fd, src_fd, offset, count ):
+    return os.copy_file_range( src_fd, dst_fd, count, offset )
+
+# The in-kernel ways of copying a file, in the order to try them. Each copies
+# from offset in the source to the destination's current position. (Elsewhere,
+# e.g. macOS, sendfile can only write to a socket, so, like shutil, only use it
+# on Linux.)
+_KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):
+    _KERNEL_COPIES.append( _copy_file_range )
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    _KERNEL_COPIES.append( _sendfile )
+
+def _fadvise( fd, *advice ):
+    # Tell the kernel how we will use fd's data, where that is supported.
+    # advice is given by name, e.g. 'SEQUENTIAL' for os.POSIX_FADV_SEQUENTIAL,
+    # since those constants only exist where posix_fadvise does.
+    if hasattr(os, 'posix_fadvise'):
+        for a in advice:
+            try:
+                os.posix_fadvise( fd, 0, 0, getattr(os, 'POSIX_FADV_' + a) )
+            except OSError:
+                # Only a hint, so it doesn't matter if it is not taken.
+                pass
+
+def _drop_cache( fd ):
+    # Drop fd's pages from the page cache. The kernel won't drop pages that are
+    # dirty or still being written back, so wait for them to reach the disk first.
+    # Where posix_fadvise doesn't exist (e.g., macOS) the sync would achieve
+    # nothing, so don't do either.
+    if hasattr(os, 'posix_fadvise'):
+        os.fdatasync( fd )
+        _fadvise( fd, 'DONTNEED' )
+
+def _remove_if_exists( path ):
+    # Clear out old output first: links cannot replace an existing file, and
+    # writing through an old link would change the original data.
+    try:
+        os.unlink( path )
+    except FileNotFoundError:
+        pass
+
+def copy_file( src, dest, dest_exists=True, drop_cache=False ):
+    """
+    Copy the contents and permission bits of src to dest, like shutil.copy, but
+    without bouncing the data through a userspace buffer when the kernel allows.
+    Uses copy_file_range (which may be a metadata-only copy on CoW filesystems),
+    then sendfile, then a plain buffered copy.
+    :param src: path of the file to copy.
+    :param dest: path of the file to write.
+    :param dest_exists: False if dest is known not to exist, so it needn't be removed first.
+    :param drop_cache: whether to write dest to disk (fdatasync) and then ask the
+        kernel to drop its pages from the page cache, so a large copy doesn't
+        crowd out other processes.
+    """
+    src_fd = os.open( src, os.O_RDONLY )
+    try:
+        # The source is read once, start to finish, so ask for a large readahead.
+        _fadvise( src_fd, 'SEQUENTIAL', 'WILLNEED' )
+        size = os.fstat( src_fd ).st_size
+        if dest_exists:
+            _remove_if_exists( dest )
+        dst_fd = os.open( dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 )
+        try:
+            copied = 0
+            for copy_fn in _KERNEL_COPIES:
+                # If an earlier method copied part of the file before giving up,
+                # carry on from there, with both files at the same offset.
+                os.lseek( dst_fd, copied, os.SEEK_SET )
+                try:
+                    # copy_fn may copy fewer bytes than asked for, so keep going until we are done.
+                    while copied < size:
+                        n = copy_fn( dst_fd, src_fd, copied, size - copied )
+                        if n == 0:
+                            break
+                        copied += n
+                    break
+                except OSError as e:
+                    if e.errno not in _NO_KERNEL_COPY:
+                        raise
+
+            if copied < size:
+                # Pick up where the kernel copy (if any) left off.
+                os.lseek( src_fd, copied, os.SEEK_SET )
+                os.lseek( dst_fd, copied, os.SEEK_SET )
+                with open( src_fd, 'rb', closefd=False ) as fsrc, open( dst_fd, 'wb', closefd=False ) as fdst:
+                    copyfileobj( fsrc, fdst, COPY_BUFSIZE )
+
+            if drop_cache:
+                _drop_cache( dst_fd )
+        finally:
+            os.close( dst_fd )
+
+        # We won't read the source again, so let its pages be dropped from the cache.
+        _fadvise( src_fd, 'DONTNEED' )
+    finally:
+        os.close( src_fd )
+
+    copymode( src, dest )
+
+
+# Linux ioctl request that makes one file share (reflink) another's data blocks.
+FICLONE = 0x40049409
+
+LINK_MODES = ( 'copy', 'reflink', 'hardlink', 'symlink', 'auto' )
+
+def reflink_file( src, dest, dest_exists=True ):
+    """
+    Make dest a copy-on-write clone of src. No data is copied, but dest is a
+    separate file that can be changed without changing src.
+    Raises OSError if the filesystem (or platform) does not support it.
+    :param src: path of the file to clone.
+    :param dest: path of the new file.
+    :param dest_exists: False if dest is known not to exist, so it needn't be removed first.
+    """
+    if dest_exists:
+        _remove_if_exists( dest )
+    if sys.platform == 'darwin':
+        import ctypes
+        libc = ctypes.CDLL( None, use_errno=True )
+        if libc.clonefile( os.fsencode(src), os.fsencode(dest), 0 ) != 0:
+            err = ctypes.get_errno()
+            raise OSError( err, os.strerror(err), dest )
+    else:
+        import fcntl
+        src_fd = os.open( src, os.O_RDONLY )
+        try:
+            dst_fd = os.open( dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666 )
+            try:
+                fcntl.ioctl( dst_fd, FICLONE, src_fd )
+            except OSError:
+                os.close( dst_fd )
+                os.unlink( dest )
+                raise
+            os.close( dst_fd )
+        finally:
+            os.close( src_fd )
+        copymode( src, dest )
+
+def hardlink_file( src, dest, dest_exists=True ):
+    """
+    Make dest a hard link to src. Note that dest and src are then the *same* file,
+    so they share their contents, owner and permissions.
+    Raises OSError if src and dest are on different filesystems.
+    :param src: path of the existing file.
+    :param dest: path of the new link.
+    :param dest_exists: False if dest is known not to exist, so it needn't be removed first.
+    """
+    if dest_exists:
+        _remove_if_exists( dest )
+    os.link( src, dest )
+
+def symlink_file( src, dest, dest_exists=True ):
+    """
+    Make dest a symbolic link to the absolute path of src. If src is later
+    moved or deleted, dest will be broken.
+    :param src: path of the existing file.
+    :param dest: path of the new link.
+    :param dest_exists: False if dest is known not to exist, so it needn't be removed first.
+    """
+    if dest_exists:
+        _remove_if_exists( dest )
+    os.symlink( os.path.abspath(src), dest )
+
+def _or_copy( link_fn, copy_fn ):
+    # Use link_fn, but copy the file with copy_fn if it can't be linked after all.
+    def link_or_copy( src, dest, dest_exists=True ):
+        try:
+            link_fn( src, dest, dest_exists=dest_exists )
+        except OSError:
+            # Whatever was at dest has been removed by now.
+            copy_fn( src, dest, dest_exists=False )
+    return link_or_copy
+
+def _probe_reflink( src, dest_dir ):
+    # Try cloning src into dest_dir once, to see whether reflinks work between them.
+    probe = os.path.join( dest_dir, '.reflink-probe-%d' % os.getpid() )
+    try:
+        reflink_file( src, probe )
+        return True
+    except OSError:
+        return False
+    finally:
+        _remove_if_exists( probe )
+
+def _probe_hardlink( src, dest_dir ):
+    # Try hard linking src into dest_dir once, to see whether hard links work
+    # between them. (On different filesystems they never do.)
+    if os.stat( src ).st_dev != os.stat( dest_dir ).st_dev:
+        return False
+    probe = os.path.join( dest_dir, '.hardlink-probe-%d' % os.getpid() )
+    try:
+        hardlink_file( src, probe )
+        return True
+    except OSError:
+        return False
+    finally:
+        _remove_if_exists( probe )
+
+# The function used to put each nii file in the new dataset; see set_link_mode.
+_copy_impl = copy_file
+
+def set_link_mode( link_mode, src, dest_dir, allow_hardlink=True, drop_cache=False ):
+    """
+    Choose, once for the whole run, how make_unisession_files puts each nii file in place:
+      copy     - copy the data.
+      reflink  - clone the file (XFS, Btrfs, APFS, ...); fail if that is not possible.
+      hardlink - hard link to the original; fail if that is not possible.
+      symlink  - symbolic link to the original.
+      auto     - reflink if that works from src to dest_dir, else hard link if src
+                 and dest_dir are on the same filesystem (and allow_hardlink is
+                 True), else copy.
+    All of the sources are in one dataset and all of the destinations in another,
+    so checking one of each is enough to decide. For the same reason, reflink and
+    hardlink are checked here, once, and a ValueError is raised if they can't be
+    used, before any file has been touched.
+    :param link_mode: one of LINK_MODES.
+    :param src: path of one of the files to be copied.
+    :param dest_dir: directory the new dataset is written to.
+    :param allow_hardlink: whether auto mode may use a hard link.
+    :param drop_cache: whether copies should drop their pages from the page cache (see copy_file).
+    :return: the link mode chosen (never auto).
+    """
+    global _copy_impl
+    if link_mode not in LINK_MODES:
+        raise ValueError( 'link_mode must be one of %s, not %s' % ( LINK_MODES, link_mode ) )
+
+    if drop_cache:
+        copy = functools.partial( copy_file, drop_cache=True )
+    else:
+        copy = copy_file
+
+    if link_mode == 'auto':
+        if _probe_reflink( src, dest_dir ):
+            link_mode = 'reflink'
+            _copy_impl = _or_copy( reflink_file, copy )
+        elif allow_hardlink and _probe_hardlink( src, dest_dir ):
+            link_mode = 'hardlink'
+            _copy_impl = _or_copy( hardlink_file, copy )
+        else:
+            link_mode = 'copy'
+            _copy_impl = copy
+    else:
+        if link_mode == 'reflink' and not _probe_reflink( src, dest_dir ):
+            raise ValueError( 'link mode reflink is not supported from %s to %s' % ( src, dest_dir ) )
+        if link_mode == 'hardlink' and not _probe_hardlink( src, dest_dir ):
+            raise ValueError( 'link mode hardlink is not possible from %s to %s '
+                              '(they may be on different filesystems)' % ( src, dest_dir ) )
+        _copy_impl = {
+            'copy': copy,
+            'reflink': reflink_file,
+            'hardlink': hardlink_file,
+            'symlink': symlink_file,
+            }[link_mode]
+
+    return link_mode
+
+
+def scan_dest_dir( path ):
+    """
+    Look at a destination directory once, so that each file written to it does
+    not need its own system call to find out whether it is already there.
+    :param path: path of the directory.
+    :return: set of the names already in the directory.
+    """
+    with os.scandir( path ) as it:
+        return { entry.name for entry in it }
+
+
+def _read_bytes( path ):
+    # Sidecars are small, so read each one in one go: normally one read call
+    # for the data, and one that finds the end of the file.
+    fd = os.open( path, os.O_RDONLY )
+    try:
+        size = os.fstat( fd ).st_size
+        chunks = []
+        while True:
+            # Ask for one more byte than expected so a file that grows is still read fully.
+            chunk = os.read( fd, size + 1 )
+            if not chunk:
+                break
+            chunks.append( chunk )
+        return b''.join( chunks )
+    finally:
+        os.close( fd )
+
+# A run of 19 or more digits: an integer that may not fit in 64 bits, which
+# orjson would read as a float. (Digits in strings or fractions match too, which
+# only means json reads the file.)
+_WIDE_INT_RE = re.compile( rb'-?\d{19,}' )
+
+def _has_non_finite( json_data ):
+    # Whether json_data holds a NaN or +/-Infinity, which orjson would write as null.
+    if isinstance(json_data, float):
+        return not math.isfinite( json_data )
+    if isinstance(json_data, dict):
+        return any( _has_non_finite(v) for v in json_data.values() )
+    if isinstance(json_data, list):
+        return any( _has_non_finite(v) for v in json_data )
+    return False
+
+def load_json( path ):
+    """
+    Read the json file at path, using orjson if it is installed.
+    orjson is stricter than json (e.g., it rejects NaN and Infinity), so
+    anything it can't read is read with json instead. So is anything with an
+    integer that may be wider than 64 bits, which orjson would turn into a float.
+    :param path: path of the json file.
+    :return: the decoded json data ({} if the file is empty).
+    """
+    raw = _read_bytes( path )
+    if not raw:
+        return {}
+    if orjson is not None and not _WIDE_INT_RE.search( raw ):
+        try:
+            return orjson.loads( raw )
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads( raw )
+
+def dump_json( path, json_data ):
+    """
+    Write json_data, indented by 2, to the file at path, using orjson if it is installed.
+    Data that orjson would not write the same way json does (NaN, Infinity,
+    integers wider than 64 bits, ...) is written with json instead. This only
+    looks at json_data as given: it can't restore a value that was already
+    changed when it was read (see load_json).
+    :param path: path of the json file.
+    :param json_data: the data to be written.
+    """
+    if orjson is not None and not _has_non_finite( json_data ):
+        try:
+            raw = orjson.dumps( json_data, option=orjson.OPT_INDENT_2 )
+        except orjson.JSONEncodeError:
+            raw = None
+        if raw is not None:
+            with open(path, mode='wb') as f:
+                f.write( raw )
+            return
+
+    with open(path, mode='w', encoding='UTF-8') as f:
+        json.dump( json_data, f, indent=2 )
+
+
+NII_EXT = '.nii.gz'
+JSON_EXT = '.json'
 
-    dest_nii = os.path.join(dest_dir, dest_filename)
-    copy( src_nii, dest_nii )
-    logging.info( '%s' % ( src_nii ) )
-    logging.info( '  -------> %s' % ( dest_nii ) )
+def _make_unisession_files( src_nii, dest_dir, dest_filename, dest_names=None ):
+    # Does the work of make_unisession_files, without the logging, so that it can
+    # run on a worker thread while the main thread logs in order.
+    # Returns what _log_unisession_files needs.
 
-    src_json = re.sub( 'nii.gz', 'json', src_nii )
-    dest_json = re.sub( 'nii.gz', 'json', dest_nii )
+    # dest_filename is a bare filename, so os.path.join's checks aren't needed.
+    dest_nii = f'{dest_dir}{os.sep}{dest_filename}'
 
-    # Read the source json.
-    json_data = {}
-    with open(src_json) as j:
-        json_data = json.load(j)
+    # Swap the suffix for the json's. Only the suffix: 'nii.gz' could (in
+    # principle) also appear elsewhere in the path. Check before copying
+    # anything, so a bad name can't leave a nii without its json.
+    assert src_nii.endswith( NII_EXT ), '%s is not a %s file' % ( src_nii, NII_EXT )
+    assert dest_nii.endswith( NII_EXT ), '%s is not a %s file' % ( dest_nii, NII_EXT )
+    src_json = src_nii[:-len(NII_EXT)] + JSON_EXT
+    dest_json = dest_nii[:-len(NII_EXT)] + JSON_EXT
+
+    dest_exists = dest_names is None or dest_filename in dest_names
+    _copy_impl( src_nii, dest_nii, dest_exists=dest_exists )
+
+    # Read the source json. Not every file has one (or its link may be broken),
+    # in which case the new json will just have the SourceFile.
+    try:
+        json_data = load_json( src_json )
+        have_src_json = True
+    except FileNotFoundError:
+        json_data = {}
+        have_src_json = False
 
     # Add the SourceFile metadata.
     json_data.update( { 'SourceFile': src_nii } )
 
     # Write the new json.
-    with open(dest_json, mode='w', encoding='UTF-8') as f:
-        json.dump( json_data, f, indent=2 )
+    dump_json( dest_json, json_data )
 
-    logging.info( '%s' % ( src_json ) )
-    logging.info( '  -------> %s' % ( dest_json ) )
+    return src_nii, dest_nii, src_json, dest_json, have_src_json
+
+def _log_unisession_files( src_nii, dest_nii, src_json, dest_json, have_src_json ):
+    logging.info( '%s', src_nii )
+    logging.info( '  -------> %s', dest_nii )
+    if have_src_json:
+        logging.info( '%s', src_json )
+        logging.info( '  -------> %s', dest_json )
+    else:
+        logging.info( '%s (not found)', src_json )
+        logging.info( '  new json: %s', dest_json )
+
+def make_unisession_files( src_nii, dest_dir, dest_filename, group=None, dest_names=None ):
+    # Copy (or link, see set_link_mode) the nii file, and write the associated json file.
+    # Make sure the new files have the correct group owner.
+    # Add the nii's source path into the new .json file.
+    # (interface() doesn't pass group: it sets the group owner at the end, once
+    # everything has been written.)
+    # dest_names, if given, is what scan_dest_dir found in dest_dir.
+    made = _make_unisession_files( src_nii, dest_dir, dest_filename, dest_names=dest_names )
+    _log_unisession_files( *made )
+    src_nii, dest_nii, src_json, dest_json, have_src_json = made
 
     if group is not None:
-        chown( dest_nii, group=group  )
-        chown( dest_json, group=group  )
+        # Change the link itself, not the file it points to, if dest_nii is a symlink.
+        gid = get_gid( group )
+        os.chown( dest_nii, -1, gid, follow_symlinks=False )
+        os.chown( dest_json, -1, gid, follow_symlinks=False )
 
     return dest_nii, dest_json
 
 
-def interface( bids_dir, participant_label, session_list=[], t1_session_label=None, t2_session_label=None, dataset_name='combined', owner_group=None ):
+# Most threads to use for the anat files, which are few but large.
+LARGE_FILE_JOBS = 4
+
+# The _*_copies generators work out every new filename, in order, yielding a
+# (src_nii, dest_dir, dest_filename) tuple for each file as soon as its name is
+# known, so copying can start while the rest are still being worked out. The
+# run numbering does not depend on the order in which the copies finish.
+
+def _anat_copies( t1ws, t2ws, new_anat_dir ):
+    width = 2
+    for anats in ( t1ws, t2ws ):
+        run = 1
+        for path, filename, ent in anats:
+            run_str = f'_run-{run:0{width}d}'
+            new_filename = _SES_RE.sub(run_str, filename)
+            yield ( path, new_anat_dir, new_filename )
+            run += 1
+
+def _func_copies( funcs, task_list, new_func_dir ):
+    for task in task_list:
+        num_tasks = len(funcs[task])
+        # Check for *more* than 99 runs of the task!
+        if num_tasks > 100:
+            width = 3
+        else:
+            width = 2
+
+        # Renumber all of the tasks, preserving the order.
+        run = 1
+        for path, filename, ent in funcs[task]:
+
+            run_str = f'_run-{run:0{width}d}'
+            run += 1
+
+            # If there is only one run of a task, BIDS does not *require* the
+            # '_run-' part of the filename. To keep things consistent throughout
+            # our pipelines, add the '_run-' to the new filename.
+            rewrite = functools.partial( _rewrite_func_part, task=task, run_str=run_str, has_run='run' in ent )
+            new_filename = _REWRITE_RE.sub( rewrite, filename )
+
+            yield ( path, new_func_dir, new_filename )
+
+def _fmap_copies( all_fmaps, new_fmap_dir ):
+    width = 2
+
+    # All of the fmaps share one run sequence, whatever their direction.
+    run = 1
+    for path, filename, ent in all_fmaps:
+        run_str = f'_run-{run:0{width}d}'
+        run += 1
+
+        # Replace the session part of the string with a run number so names will
+        # still be unique.
+        new_filename = _SES_RE.sub(run_str, filename)
+        yield ( path, new_fmap_dir, new_filename )
+
+
+def subject_indexer( participant_label ):
+    """
+    Make a BIDSLayoutIndexer that only indexes one subject, so that the time it
+    takes to make the layout depends on the size of the subject, not the dataset.
+    :param participant_label: the subject to be indexed (without "sub-").
+    :return: BIDSLayoutIndexer.
+    """
+    # Ignore every path part that starts with sub-<some other label>. The
+    # lookahead keeps sub-<participant_label> itself, and its files, which
+    # start with sub-<participant_label>_.
+    other_subjects = re.compile( r'(?:^|/)sub-(?!%s(?:[/_]|$))' % re.escape(participant_label) )
+    return BIDSLayoutIndexer( ignore=list(DEFAULT_LOCATIONS_TO_IGNORE) + [ other_subjects ] )
+
+def get_gid( group ):
+    """
+    Look up a group's ID, once, so it doesn't have to be looked up for every file.
+    :param group: group name or ID.
+    :return: the numeric group ID.
+    """
+    if isinstance(group, int):
+        return group
+    if group.isdigit():
+        return int(group)
+    return grp.getgrnam( group ).gr_gid
+
+
+def interface( bids_dir, participant_label, session_list=[], t1_session_label=None, t2_session_label=None, dataset_name='combined', owner_group=None, jobs=None, layout_db=None, link_mode='copy', drop_cache=False ):
     """
     Main application interface.
     :param bids_dir: required, input directory.
@@ -184,42 +756,73 @@ def interface( bids_dir, participant_label, session_list=[], t1_session_label=No
     :param t2_session_label: optional, session that has T2w data to be included.
     :param dataset_name: optional, name to be used for desc- part of output dir.
     :param owner_group: optional, group owner for new paths and files.
+    :param jobs: optional, number of func and fmap files to copy concurrently.
+    :param layout_db: optional, path of a saved BIDSLayout database to use (or create).
+    :param link_mode: optional, how to put the nii files in place (see set_link_mode).
+    :param drop_cache: optional, drop copied files from the page cache as they are written.
     """
     subject = 'sub-' + participant_label
 
     # Parameter checking....
+    assert link_mode in LINK_MODES, 'link mode must be one of %s, not %s' % ( LINK_MODES, link_mode )
+    # A hard link *is* the original file, so changing its group would change
+    # the group of the file in the input dataset.
+    assert not ( link_mode == 'hardlink' and owner_group is not None ), 'link mode hardlink cannot be used with an owner group'
+    if jobs is None:
+        jobs = min(32, (os.cpu_count() or 1) * 4)
+    assert jobs > 0, 'jobs must be at least 1, not %s' % jobs
+
     # Make sure the output dir is valid and that we can write to it.
     output_dir = os.path.join(bids_dir, '../niftis_desc-%s' % dataset_name)
     new_subject_dir = os.path.join(output_dir, subject)
     os.makedirs(new_subject_dir, exist_ok=True)
     if owner_group is not None:
-        chown( output_dir, group=owner_group  )
-        chown( new_subject_dir, group=owner_group  )
+        # Fails here, before anything is copied, if there is no such group.
+        owner_gid = get_gid( owner_group )
 
     # Log everything used to process the data for this subject.
     log_path = os.path.join( new_subject_dir, 'README' )
     log_format = '%(levelname)s: %(message)s'
-    logging.basicConfig( filename=log_path, format=log_format, level=logging.INFO )
+    # Buffer the log records and write them to the file in batches, rather than
+    # writing (and taking the file handler's lock) for every line. This is what
+    # basicConfig would do, other than the buffering.
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        file_handler = logging.FileHandler( log_path )
+        file_handler.setFormatter( logging.Formatter( log_format ) )
+        log_handler = logging.handlers.MemoryHandler( capacity=1000, target=file_handler )
+        root_logger.addHandler( log_handler )
+        root_logger.setLevel( logging.INFO )
+        atexit.register( log_handler.flush )
     logging.captureWarnings(True)
     logging.info( time.ctime() )
     logging.info( 'Combine Files was run with these values:' )
-    logging.info( 'BIDS directory: %s' % bids_dir )
-    logging.info( 'Participant label: %s' % participant_label )
-    logging.info( 'Session list: %s' %  session_list )
-    logging.info( 'T1w session label: %s' % t1_session_label )
-    logging.info( 'T2w session label: %s' % t2_session_label )
-    logging.info( 'Dataset name: %s' % dataset_name )
-    logging.info( 'Owner group: %s' % owner_group )
+    logging.info( 'BIDS directory: %s', bids_dir )
+    logging.info( 'Participant label: %s', participant_label )
+    logging.info( 'Session list: %s', session_list )
+    logging.info( 'T1w session label: %s', t1_session_label )
+    logging.info( 'T2w session label: %s', t2_session_label )
+    logging.info( 'Dataset name: %s', dataset_name )
+    logging.info( 'Owner group: %s', owner_group )
+    logging.info( 'Jobs: %s', jobs )
+    logging.info( 'Layout database: %s', layout_db )
+    logging.info( 'Link mode: %s', link_mode )
+    logging.info( 'Drop cache: %s', drop_cache )
 
     new_anat_dir = os.path.join(new_subject_dir, 'anat')
     os.makedirs(new_anat_dir, exist_ok=True)
-    if owner_group is not None:
-        chown( new_anat_dir, group=owner_group  )
 
     # Make sure we can get to the input we need.
     # Get the bids layout.
     assert os.path.isdir(bids_dir), '%s is not a directory!' % bids_dir
-    layout = BIDSLayout(bids_dir, absolute_paths=True)
+    if layout_db is None:
+        # Only index the subject we need.
+        layout = BIDSLayout(bids_dir, indexer=subject_indexer(participant_label))
+    else:
+        # Reuse the index saved in layout_db, if there is one. Otherwise,
+        # index bids_dir and save the index there for next time. Since it
+        # may be reused for other subjects, this indexes the whole dataset.
+        layout = BIDSLayout(bids_dir, database_path=layout_db)
     assert layout is not None, 'Unable to get bids layout from directory!' % bids_dir
 
     # Get the list of subjects.
@@ -260,119 +863,123 @@ def interface( bids_dir, participant_label, session_list=[], t1_session_label=No
         assert t2_session_label in session_list, 'session for T2ws (%s) is not in the list of sessions to be combined' % t2_session_label
         t2w_sessions.append(t2_session_label)
 
-    t1ws=[]
-    t2ws=[]
-    all_fmaps=[]
+    # Query the layout once per datatype, then put the files back into the
+    # order of the sessions being combined. (The sorts are stable, so files
+    # keep the order BIDSLayout gave them within each session.)
+    # Each file's path, filename and entities are worked out once here, from
+    # the path alone, and kept as a (path, filename, entities) tuple, so the
+    # loops below don't go back to pybids for every property.
+    def get_files(**query):
+        files = []
+        for f in layout.get(subject=participant_label, **query):
+            path = f.path
+            filename = os.path.basename(path)
+            files.append( (path, filename, parse_entities(filename)) )
+        files.sort(key=lambda pfe: session_list.index(pfe[2]['ses']))
+        return files
+
+    t1ws = get_files(session=t1w_sessions, datatype='anat', suffix='T1w', extension='nii.gz')
+    t2ws = get_files(session=t2w_sessions, datatype='anat', suffix='T2w', extension='nii.gz')
+
+    # Get all fmaps.
+    all_fmaps = get_files(session=session_list, datatype='fmap', extension='.nii.gz')
+
+    # Get list of funcs for each task.
     funcs={}
     for task in task_list:
         funcs[task] = []
-
-    # Visit each session being combined, in the order specified, to get files.
-    for session in session_list:
-        if session in t1w_sessions:
-            t1ws_subset = layout.get(subject=participant_label, session=session, datatype='anat', suffix='T1w', extension='nii.gz')
-            t1ws.extend(t1ws_subset)
-        if session in t2w_sessions:
-            t2ws_subset = layout.get(subject=participant_label, session=session, datatype='anat', suffix='T2w', extension='nii.gz')
-            t2ws.extend(t2ws_subset)
-
-        # Get all fmaps.
-        all_fmaps.extend(layout.get(subject=participant_label, session=session, datatype='fmap', extension='.nii.gz'))
-
-        # Get list of funcs for each task.
-        for task in task_list:
-            funcs_subset = layout.get(subject=participant_label, session=session, task=task, datatype='func', extension='.nii.gz')
-            funcs[task].extend(funcs_subset)
+    for path, filename, ent in get_files(session=session_list, datatype='func', extension='.nii.gz'):
+        task = ent.get('task')
+        if task in funcs:
+            funcs[task].append( (path, filename, ent) )
 
     assert len(t1ws) > 0, 'No T1w data were found for %s in session(s) %s ' % (subject, t1w_sessions)
     assert len(t2ws) > 0, 'No T2w data were found for %s in session(s) %s ' % (subject, t2w_sessions)
 
     if len(funcs) == 0:
-        logging.warning("Subject %s has only anatomical data." % subject)
+        logging.warning("Subject %s has only anatomical data.", subject)
 
     if len(all_fmaps) == 0:
-        logging.warning('No fmap data were found for subject %s.' % subject)
+        logging.warning('No fmap data were found for subject %s.', subject)
 
     # Have what we need, ready to go!
-    width = 2
-    run = 1
-    for t in t1ws:
-        run_str = '_run-' + str(run).zfill(width)
-        new_filename = re.sub(r'_ses-[^_]+', run_str, t.filename)
-        make_unisession_files( t.path, new_anat_dir, new_filename, group=owner_group )
-        run += 1
-
-    run = 1
-    for t in t2ws:
-        run_str = '_run-' + str(run).zfill(width)
-        new_filename = re.sub(r'_ses-[^_]+', run_str, t.filename)
-        make_unisession_files( t.path, new_anat_dir, new_filename, group=owner_group )
-        run += 1
-
     if len(funcs) > 0:
         new_func_dir = os.path.join(new_subject_dir, 'func')
         os.makedirs(new_func_dir, exist_ok=True)
-
-    for task in task_list:
-        num_tasks = len(funcs[task])
-        # Check for *more* than 99 runs of the task!
-        if num_tasks > 100:
-            width = 3
-        else:
-            width = 2
-
-        # Renumber all of the tasks, preserving the order.
-        run = 1
-        for f in funcs[task]:
-
-            run_str = '_run-' + str(run).zfill(width)
-            run += 1
-
-            new_filename = re.sub( r'_ses-[^_]+', '', f.filename )
-            if '_run-' in new_filename:
-                new_filename = re.sub( r'_run-[\d]+', run_str, new_filename )
-            else:
-                # If there is only one run of a task, BIDS does not *require* the
-                # '_run-' part of the filename. To keep things consistent throughout
-                # our pipelines, add the '_run-' to the new filename.
-                new_filename = re.sub( r'task-[^_]+', 'task-' + task + run_str, new_filename )
-
-            make_unisession_files( f.path, new_func_dir, new_filename, group=owner_group )
-
-    width = 2
-
+    else:
+        new_func_dir = None
 
     if len(all_fmaps) > 0:
         new_fmap_dir = os.path.join(new_subject_dir, 'fmap')
         os.makedirs(new_fmap_dir, exist_ok=True)
-
-        gen_fmaps=[]
-        aps=[]
-        pas=[]
-
-        for f in all_fmaps:
-            direct = f.get_entities().get('dir', 'NODIR').upper()
-            if direct == 'PA':
-                pas.append(f)
-                run_str = '_run-' + str(len(pas)).zfill(width)
-
-            elif direct == 'AP':
-                aps.append(f)
-                run_str = '_run-' + str(len(aps)).zfill(width)
-
-            elif direct == 'NODIR':
-                gen_fmaps.append(f)
-                run_str = '_run-' + str(len(gen_fmaps)).zfill(width)
-
-            else:
-                logging.warning('Direction \"%s\" was not recognized.' % direct)
-                gen_fmaps.append(f)
-                run_str = '_run-' + str(len(gen_fmaps)).zfill(width)
-
-            # Replace the session part of the string with a run number so names will
-            # still be unique.
-            new_filename = re.sub(r'_ses-[^_]+', run_str, f.filename)
-            make_unisession_files( f.path, new_fmap_dir, new_filename, group=owner_group )
+    else:
+        new_fmap_dir = None
+
+    # Scan each destination directory once, rather than checking for each file.
+    dest_dirs = {}
+    for dest_dir in ( new_anat_dir, new_func_dir, new_fmap_dir ):
+        if dest_dir is not None:
+            dest_dirs[dest_dir] = scan_dest_dir( dest_dir )
+
+    # Decide how to put the nii files in place once, rather than for every file.
+    # A hard link shares its owner with the original, so don't let auto mode
+    # pick one when we are about to change the group.
+    chosen_mode = set_link_mode( link_mode, t1ws[0][0], new_subject_dir, allow_hardlink=owner_group is None,
+                                 drop_cache=drop_cache )
+    logging.info( 'Link mode used: %s', chosen_mode )
+
+    def copy_one( src_nii, dest_dir, dest_filename ):
+        return _make_unisession_files( src_nii, dest_dir, dest_filename, dest_names=dest_dirs[dest_dir] )
+
+    # The copies are I/O bound, so run them concurrently.
+    # The few, large anat files saturate the storage with a handful of threads,
+    # while the many smaller func and fmap files need more threads in flight.
+    # Each copy is logged as soon as it, and every copy submitted before it, is
+    # done, so the README lists the files in run order, whichever thread
+    # finished first, and is up to date if the run is stopped part way through.
+    futures = []
+    logged = 0
+    try:
+        with ThreadPoolExecutor(max_workers=min(LARGE_FILE_JOBS, jobs)) as pool_large, \
+             ThreadPoolExecutor(max_workers=jobs) as pool_many:
+            futures.extend( pool_large.submit( copy_one, *c ) for c in _anat_copies( t1ws, t2ws, new_anat_dir ) )
+            futures.extend( pool_many.submit( copy_one, *c ) for c in _func_copies( funcs, task_list, new_func_dir ) )
+            futures.extend( pool_many.submit( copy_one, *c ) for c in _fmap_copies( all_fmaps, new_fmap_dir ) )
+
+            # Raise the first error as soon as it happens, without starting any
+            # more copies.
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    while logged < len(futures) and futures[logged].done():
+                        _log_unisession_files( *futures[logged].result() )
+                        logged += 1
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        # After an error, the pools wait for the copies already under way.
+        # Log the ones that finished, so every file written is in the README.
+        for future in futures[logged:]:
+            if not future.cancelled() and future.exception() is None:
+                _log_unisession_files( *future.result() )
+
+    # Set the group owner of what this run wrote, now that it's all there,
+    # rather than file by file. Only those paths: the output may also hold
+    # files from an earlier run, which could be hard links to the input dataset.
+    # Symbolic links themselves are changed, not the files they point to.
+    if owner_group is not None:
+        # (The README is only there if this run set up the logging.)
+        new_paths = [ output_dir, new_subject_dir, new_anat_dir, new_func_dir, new_fmap_dir ]
+        if os.path.exists( log_path ):
+            new_paths.append( log_path )
+        for future in futures:
+            src_nii, dest_nii, src_json, dest_json, have_src_json = future.result()
+            new_paths.extend( ( dest_nii, dest_json ) )
+        for path in new_paths:
+            if path is not None:
+                os.chown( path, -1, owner_gid, follow_symlinks=False )
 
     # TODO: edit IntendedFor field of each new fmap json: fix dir (new_anat or new_func) and fname!
 